@@ -1,44 +1,70 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
 import numpy as np
-from datetime import date, timedelta
+import orjson
+from datetime import date, datetime, timedelta, timezone
 from urllib.parse import unquote
+from traffic_kernels import congestion_score
+
+# Serialize Plotly figures with orjson instead of the stdlib json encoder
+pio.json.config.default_engine = 'orjson'
 
 # --- Configuration for Simulated NYC Road Traffic Data ---
 LAT_MIN, LAT_MAX = 40.70, 40.80
 LON_MIN, LON_MAX = -74.02, -73.93
 
+# --- Configuration for Wikipedia Pageview Caching ---
+# Trailing UTC days that may still be unpublished and so are never persisted to disk
+RECENT_PAGEVIEW_DAYS = 3
+
 # --- Functions for Simulated Road Traffic Analytics ---
 
-def generate_simulated_traffic_data():
-    """Generates a DataFrame of random traffic data for a small area in NYC."""
-    lat_vals = np.linspace(LAT_MIN, LAT_MAX, 15)
-    lon_vals = np.linspace(LON_MIN, LON_MAX, 15)
-    records = []
-    for lat in lat_vals:
-        for lon in lon_vals:
-            records.append({
-                "lat": lat,
-                "lon": lon,
-                "currentSpeed": np.random.uniform(10, 60),
-                "freeFlowSpeed": np.random.uniform(40, 70),
-                "jamFactor": np.random.uniform(0, 10),
-                "confidence": np.random.uniform(0.5, 1)
-            })
-    return pd.DataFrame(records)
+@st.cache_resource
+def traffic_grid(n=15):
+    """Returns the flattened lat/lon coordinates of an n x n grid over the sample area."""
+    lat, lon = np.meshgrid(
+        np.linspace(LAT_MIN, LAT_MAX, n),
+        np.linspace(LON_MIN, LON_MAX, n),
+        indexing='ij'
+    )
+    lat, lon = lat.ravel(), lon.ravel()
+    # The arrays are shared between callers, so guard them against mutation
+    lat.flags.writeable = False
+    lon.flags.writeable = False
+    return lat, lon
 
-def display_road_traffic_analytics():
-    """Displays maps and charts for the simulated road traffic data."""
-    st.markdown("## Simulated NYC Road Traffic Analytics")
-    st.info("This section displays randomly generated traffic data for a sample area in New York City.")
-    
-    df = generate_simulated_traffic_data()
-    st.dataframe(df.head(10))
+@st.cache_data(ttl=3600)
+def generate_simulated_traffic_data(seed=0):
+    """Generates a DataFrame of random traffic data for a small area in NYC.
+    Values are stored as float32, which is ample for the displayed precision."""
+    rng = np.random.default_rng(seed)
+    lat, lon = traffic_grid()
+    n = lat.size
+    df = pd.DataFrame({
+        "lat": lat,
+        "lon": lon,
+        "currentSpeed": rng.uniform(10, 60, n),
+        "freeFlowSpeed": rng.uniform(40, 70, n),
+        "jamFactor": rng.uniform(0, 10, n),
+        "confidence": rng.uniform(0.5, 1, n)
+    }, dtype=np.float32)
+    df["congestionScore"] = congestion_score(
+        df["jamFactor"].to_numpy(),
+        df["currentSpeed"].to_numpy(),
+        df["freeFlowSpeed"].to_numpy(),
+        df["confidence"].to_numpy()
+    )
+    return df
 
-    # --- Traffic Jam Heatmap ---
-    st.markdown("### Traffic Jam Factor Heatmap")
+@st.cache_data
+def build_jam_map(df):
+    """Builds the jam factor heatmap for the simulated traffic data."""
     fig_map = px.scatter_mapbox(
         df,
         lat="lat",
@@ -48,62 +74,151 @@ def display_road_traffic_analytics():
         size_max=15,
         color_continuous_scale=px.colors.sequential.OrRd,
         hover_name="currentSpeed",
-        hover_data={"currentSpeed": True, "freeFlowSpeed": True, "jamFactor": True},
+        hover_data={"currentSpeed": True, "freeFlowSpeed": True, "jamFactor": True, "congestionScore": True},
         zoom=12,
         height=500,
         title="Higher 'Jam Factor' indicates worse traffic conditions",
     )
     fig_map.update_layout(mapbox_style="open-street-map", margin={"r":0,"t":40,"l":0,"b":0})
+    return fig_map
+
+@st.cache_data
+def build_speed_fig(df):
+    """Builds the current vs free flow speed line chart."""
+    # Rows come from an 'ij'-indexed grid, so they are already sorted by latitude
+    return px.line(
+        df,
+        x="lat",
+        y=["currentSpeed", "freeFlowSpeed"],
+        title="Current Speed vs Free Flow Speed",
+        labels={"value": "Speed (km/h)", "lat": "Latitude"},
+        render_mode='webgl'
+    )
+
+@st.cache_data
+def build_jam_hist(df):
+    """Builds the jam factor distribution histogram.
+    Bins are counted here so only the bin counts are sent to the browser, and
+    the bin count buttons switch between precomputed bins with Plotly.restyle."""
+    jam = df["jamFactor"].to_numpy()
+    bin_options = [10, 20, 40]
+    default_bins = 20
+
+    buttons = []
+    for bins in bin_options:
+        counts, edges = np.histogram(jam, bins=bins)
+        bars = {"x": 0.5 * (edges[:-1] + edges[1:]), "y": counts, "width": np.diff(edges)}
+        if bins == default_bins:
+            default_bars = bars
+        buttons.append(dict(
+            label=f"{bins} bins",
+            method="restyle",
+            args=[{key: [value] for key, value in bars.items()}]
+        ))
+
+    fig_jam = go.Figure(go.Bar(name="Jam Factor", **default_bars))
+    fig_jam.update_layout(
+        title="Distribution of Traffic Jam Factor",
+        xaxis_title="Jam Factor",
+        yaxis_title="count",
+        bargap=0,
+        updatemenus=[dict(
+            type="buttons",
+            direction="right",
+            active=bin_options.index(default_bins),
+            buttons=buttons,
+            x=1,
+            y=1.15,
+            xanchor="right",
+            yanchor="bottom"
+        )]
+    )
+    return fig_jam
+
+def display_road_traffic_analytics():
+    """Displays maps and charts for the simulated road traffic data."""
+    st.markdown("## Simulated NYC Road Traffic Analytics")
+    st.info("This section displays randomly generated traffic data for a sample area in New York City.")
+    
+    df = generate_simulated_traffic_data()
+    # Let the Arrow-backed grid window the rows instead of slicing a copy
+    st.dataframe(df, height=280, hide_index=True, use_container_width=True)
+
+    # --- Traffic Jam Heatmap ---
+    st.markdown("### Traffic Jam Factor Heatmap")
+    fig_map = build_jam_map(df)
     st.plotly_chart(fig_map, use_container_width=True)
 
     # --- Speed Comparison Line Chart ---
     col1, col2 = st.columns(2)
     with col1:
         st.markdown("### Traffic Speed Analysis")
-        fig_speed = px.line(
-            df.sort_values(by="lat"),
-            x="lat",
-            y=["currentSpeed", "freeFlowSpeed"],
-            title="Current Speed vs Free Flow Speed",
-            labels={"value": "Speed (km/h)", "lat": "Latitude"}
-        )
+        fig_speed = build_speed_fig(df)
         st.plotly_chart(fig_speed, use_container_width=True)
 
     # --- Jam Factor Distribution ---
     with col2:
         st.markdown("### Jam Factor Distribution")
-        fig_jam = px.histogram(
-            df,
-            x="jamFactor",
-            nbins=20,
-            title="Distribution of Traffic Jam Factor",
-            labels={"jamFactor": "Jam Factor"}
-        )
+        fig_jam = build_jam_hist(df)
         st.plotly_chart(fig_jam, use_container_width=True)
 
     # --- Aggregate Metrics ---
-    avg_speed = df["currentSpeed"].mean()
-    avg_free_speed = df["freeFlowSpeed"].mean()
-    avg_jam = df["jamFactor"].mean()
-    max_jam = df["jamFactor"].max()
+    current_speed = df["currentSpeed"].to_numpy()
+    free_speed = df["freeFlowSpeed"].to_numpy()
+    jam = df["jamFactor"].to_numpy()
+    avg_speed = current_speed.mean()
+    avg_free_speed = free_speed.mean()
+    avg_jam = jam.mean()
+    max_jam = jam.max()
 
     st.markdown("### Aggregate Traffic Insights")
-    st.markdown(f"- Average Current Speed: **{avg_speed:.2f} km/h**")
-    st.markdown(f"- Average Free Flow Speed: **{avg_free_speed:.2f} km/h**")
-    st.markdown(f"- Average Jam Factor: **{avg_jam:.2f}**")
-    st.markdown(f"- Maximum Jam Factor: **{max_jam:.2f}**")
+    kpi1, kpi2, kpi3, kpi4 = st.columns(4)
+    kpi1.metric("Average Current Speed", f"{avg_speed:.2f} km/h")
+    kpi2.metric("Average Free Flow Speed", f"{avg_free_speed:.2f} km/h")
+    kpi3.metric("Average Jam Factor", f"{avg_jam:.2f}")
+    kpi4.metric("Maximum Jam Factor", f"{max_jam:.2f}")
 
 
 # --- Functions for Wikipedia Article Traffic Analytics ---
 
-def fetch_wikipedia_pageviews(article, start_date, end_date):
+class BoundedRetry(Retry):
+    """Retry policy that honours Retry-After but never waits longer than a few seconds."""
+    MAX_RETRY_AFTER = 5
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.MAX_RETRY_AFTER)
+
+@st.cache_resource
+def get_wikimedia_session():
+    """Returns a shared HTTP session so Wikimedia connections are kept alive across reruns."""
+    session = requests.Session()
+    session.headers.update({
+        'User-Agent': 'StreamlitApp/1.0 (https://your-app-url.com; your-email@example.com)'
+    })
+    # 429 is deliberately not retried: retrying a rate limit only makes it worse,
+    # so it surfaces immediately through raise_for_status. Retry-After is still
+    # honoured for 503, capped so a stalled worker stays bounded.
+    retries = BoundedRetry(
+        total=3,
+        connect=2,
+        read=2,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=['GET'],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=8, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+def request_wikipedia_pageviews(article, start_date, end_date):
     """
-    Fetches daily pageview data for a Wikipedia article using the Wikimedia API.
-    This API is free and requires no authentication.
+    Requests daily pageview data for a Wikipedia article from the Wikimedia API.
+    Raises on HTTP errors so failed requests are never cached.
     """
-    headers = {
-        'User-Agent': 'StreamlitApp/1.0 (https://your-app-url.com; your-email@example.com)'
-    }
     # Format dates for the API URL
     start_str = start_date.strftime('%Y%m%d')
     end_str = end_date.strftime('%Y%m%d')
@@ -116,22 +231,87 @@ def fetch_wikipedia_pageviews(article, start_date, end_date):
         f"en.wikipedia/all-access/user/{article_formatted}/daily/{start_str}/{end_str}"
     )
     
+    # Bound connect and read time so a stalled request cannot hang the worker
+    response = get_wikimedia_session().get(url, timeout=(3, 10))
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    
+    if 'items' in data:
+        # Only the timestamp and views fields are used; skip building the rest
+        items = data['items']
+        timestamps = [item['timestamp'][:8] for item in items]
+        views = np.fromiter((item['views'] for item in items), dtype=np.int64, count=len(items))
+        # Timestamps are fixed-width YYYYMMDD00; parse the date part once per unique value
+        return pd.DataFrame({
+            'date': pd.to_datetime(timestamps, format='%Y%m%d', cache=True),
+            'pageviews': views
+        })
+    else:
+        return None
+
+@st.cache_data(persist="disk", max_entries=256, show_spinner=False)
+def request_archived_pageviews(article, start_date, end_date):
+    """
+    Requests pageviews for settled past days, which never change, persisting them across restarts.
+    Only called for ranges ending before the recent window, so no completeness check is needed.
+    """
+    return request_wikipedia_pageviews(article, start_date, end_date)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def request_recent_pageviews(article, start_date, end_date):
+    """Requests pageviews for recent days, which may not be published yet."""
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 404:
-            st.error(f"API Error 404: Not Found. This often means the article '{article}' does not exist on English Wikipedia. Please check the spelling and try again.")
+        return request_wikipedia_pageviews(article, start_date, end_date)
+    except requests.HTTPError as e:
+        # The API answers 404 when none of the requested days are available yet
+        if e.response is not None and e.response.status_code == 404:
             return None
-        response.raise_for_status()
-        data = response.json()
-        
-        if 'items' in data:
-            df = pd.DataFrame(data['items'])
-            df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y%m%d00')
-            df = df.rename(columns={'views': 'pageviews', 'timestamp': 'date'})
-            return df[['date', 'pageviews']]
+        raise
+
+def load_wikipedia_pageviews(article, start_date, end_date):
+    """
+    Loads pageviews for a date range, splitting it so that only the trailing
+    days still being published are ever refetched from the API.
+    """
+    # Wikimedia days are UTC days, published with a lag of up to about a day.
+    # The response alone can't show completeness, since days with no views are omitted.
+    recent_start = datetime.now(timezone.utc).date() - timedelta(days=RECENT_PAGEVIEW_DAYS - 1)
+    frames = []
+    archived_404 = None
+    if start_date < recent_start:
+        archived_end = min(end_date, recent_start - timedelta(days=1))
+        try:
+            frames.append(request_archived_pageviews(article, start_date, archived_end))
+        except requests.HTTPError as e:
+            # No archived data yet, e.g. an article created in the last few days
+            if e.response is None or e.response.status_code != 404:
+                raise
+            archived_404 = e
+    if end_date >= recent_start:
+        frames.append(request_recent_pageviews(article, max(start_date, recent_start), end_date))
+
+    frames = [df for df in frames if df is not None]
+    if not frames:
+        if archived_404 is not None:
+            raise archived_404
+        return None
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+def fetch_wikipedia_pageviews(article, start_date, end_date):
+    """
+    Fetches daily pageview data for a Wikipedia article using the Wikimedia API.
+    This API is free and requires no authentication.
+    """
+    try:
+        return load_wikipedia_pageviews(article, start_date, end_date)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            st.error(f"API Error 404: Not Found. This often means the article '{article}' does not exist on English Wikipedia. Please check the spelling and try again.")
         else:
-            return None
-            
+            st.error(f"API request failed: {e}")
+        return None
     except requests.RequestException as e:
         st.error(f"API request failed: {e}")
         return None
@@ -139,6 +319,22 @@ def fetch_wikipedia_pageviews(article, start_date, end_date):
         st.error(f"An error occurred while processing data: {e}")
         return None
 
+@st.cache_data(ttl=3600, max_entries=64)
+def build_pageviews_fig(views_df, article_title):
+    """Builds the daily pageviews line chart for an article."""
+    fig = px.line(
+        views_df,
+        x='date',
+        y='pageviews',
+        title=f"Daily Traffic for '{article_title}'",
+        labels={'pageviews': 'Number of Pageviews', 'date': 'Date'}
+    )
+    fig.update_layout(hovermode="x unified")
+    # Range changes are handled in the browser instead of rerunning the script.
+    # The range slider only previews SVG traces, so this chart is not WebGL-rendered.
+    fig.update_xaxes(rangeslider_visible=True)
+    return fig
+
 def display_wikipedia_analytics():
     """Displays UI for fetching and showing Wikipedia pageview data."""
     st.markdown("## Wikipedia Article Traffic Analytics")
@@ -178,31 +374,27 @@ def display_wikipedia_analytics():
             st.success(f"Successfully retrieved data for '{article_title}'!")
             
             # --- Key Metrics ---
-            total_views = views_df['pageviews'].sum()
-            avg_views = views_df['pageviews'].mean()
-            max_views_row = views_df.loc[views_df['pageviews'].idxmax()]
+            pageviews = views_df['pageviews'].to_numpy()
+            total_views = pageviews.sum()
+            avg_views = pageviews.mean()
+            peak_idx = int(np.argmax(pageviews))
+            peak_views = pageviews[peak_idx]
+            peak_date = views_df['date'].iat[peak_idx]
             
             st.markdown("### Key Metrics")
             kpi1, kpi2, kpi3 = st.columns(3)
             kpi1.metric("Total Pageviews", f"{total_views:,.0f}")
             kpi2.metric("Average Daily Views", f"{avg_views:,.0f}")
-            kpi3.metric("Peak Day Views", f"{max_views_row['pageviews']:,.0f}", f"{max_views_row['date'].strftime('%b %d, %Y')}")
+            kpi3.metric("Peak Day Views", f"{peak_views:,.0f}", f"{peak_date.strftime('%b %d, %Y')}")
 
             # --- Pageviews Line Chart ---
             st.markdown("### Daily Pageviews Over Time")
-            fig = px.line(
-                views_df,
-                x='date',
-                y='pageviews',
-                title=f"Daily Traffic for '{article_title}'",
-                labels={'pageviews': 'Number of Pageviews', 'date': 'Date'}
-            )
-            fig.update_layout(hovermode="x unified")
+            fig = build_pageviews_fig(views_df, article_title)
             st.plotly_chart(fig, use_container_width=True)
             
             # --- Raw Data ---
             with st.expander("Show Raw Data"):
-                st.dataframe(views_df)
+                st.dataframe(views_df, height=280, hide_index=True, use_container_width=True)
         else:
             st.error(f"Could not retrieve or process data for '{article_title}'. Please check the article title and try again.")
 
@@ -0,0 +1,18 @@
+import numpy as np
+from numba import njit, prange
+
+# --- Compiled Kernels for Traffic Analytics ---
+# Kept in an imported module so Streamlit's script reruns don't redefine them.
+
+@njit(parallel=True, fastmath=True, cache=True)
+def congestion_score(jam, current_speed, free_speed, confidence):
+    """Blends jam factor and speed drop into a 0-10 congestion score, weighted by confidence."""
+    out = np.empty_like(jam)
+    for i in prange(jam.size):
+        speed_drop = max(0.0, 1.0 - current_speed[i] / free_speed[i])
+        out[i] = confidence[i] * (0.6 * jam[i] + 0.4 * speed_drop * 10.0)
+    return out
+
+# Compile for the float32 traffic columns at import so the first page load doesn't wait on it
+_warmup = np.ones(1, dtype=np.float32)
+congestion_score(_warmup, _warmup, _warmup, _warmup)